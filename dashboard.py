@@ -10,10 +10,13 @@ import os
 import sqlite3
 from typing import Tuple
 
+import numpy as np
 import pandas as pd
 import altair as alt
 import streamlit as st
 
+from db_init import TRADES_SCORED_VIEW
+
 DB_PATH = os.getenv("RISK_DB", "risk_demo.sqlite")
 
 # -------------------- Page setup --------------------
@@ -27,6 +30,11 @@ st.set_page_config(
 # -------------------- Styling helpers --------------------
 SEV_COLORS = {"INFO": "#2b8a3e", "WARNING": "#e67700", "CRITICAL": "#c92a2a"}
 DEC_EMOJI = {"ALLOW": "🟢", "REVIEW": "🟠", "BLOCK": "🔴"}
+SEV_EMOJI = {"INFO": "ℹ️", "WARNING": "⚠️", "CRITICAL": "🚨"}
+# ALLOW trades scored without DEBUG logging have a NULL reason: nothing was recorded, which
+# is not the same as "no rule fired"
+ALLOW_REASONS_MISSING = "Reasons not recorded for ALLOW"
+DEC_SEVERITY = {"BLOCK": "CRITICAL", "REVIEW": "WARNING", "ALLOW": "INFO"}  # as the SQL CASE; anything else -> INFO
 
 def tag(label, color):
     st.markdown(
@@ -62,54 +70,146 @@ def money_disp(x: float) -> str:
         return f"₹{amt:,.0f}"
     return f"${amt:,.0f}"
 
+def money_series(s: pd.Series) -> pd.Series:
+    """money_disp for a whole column: one vectorized convert/round, then format."""
+    inr = DISPLAY_CCY.startswith("INR")
+    factor = usd_to_inr if inr else 1.0
+    sym = "₹" if inr else "$"
+    vals = (pd.to_numeric(s, errors="coerce").fillna(0.0).to_numpy() * factor).round().astype(np.int64)
+    return pd.Series([f"{sym}{v:,}" for v in vals.tolist()], index=s.index)
+
 st.sidebar.button("🔄 Refresh")
 
 # -------------------- Data access --------------------
-def read_sql(query: str, params=()):
-    with sqlite3.connect(DB_PATH) as con:
-        return pd.read_sql_query(query, con, params=params)
+@st.cache_resource
+def get_conn() -> sqlite3.Connection:
+    # one connection shared across reruns/sessions so the page cache stays warm
+    con = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    con.execute("PRAGMA cache_size=-200000")  # ~200 MB
+    con.execute("PRAGMA mmap_size=268435456")
+    con.execute(TRADES_SCORED_VIEW)  # no-op once db_init has created it
+    return con
+
+# Rows pulled into pandas for the Alerts tab (the only view that shows rows)
+ALERT_ROWS_LIMIT = 2000
+CATEGORY_COLS = ["currency", "country", "counterparty", "decision", "severity", "sector", "trade_type", "status"]
 
 @st.cache_data(ttl=5.0)
-def load_core() -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
-    # trades
-    trades = read_sql("""
+def load_core() -> Tuple[pd.DataFrame, pd.DataFrame]:
+    # most recent ALERT_ROWS_LIMIT trades with their scores (join done by the trades_scored view)
+    df = pd.read_sql_query("""
         SELECT trade_id, timestamp, counterparty, sector, country, symbol, trade_type,
-               quantity, price, notional, currency, kyc_ok, aml_flag, status
-        FROM trades
-    """)
-
-    # risk_scores (map old -> friendly names)
-    scores = read_sql("""
-        SELECT trade_id,
-               base_rule_score  AS rule_score,
-               ml_anomaly_score AS ml_score,
-               combined_score,
-               decision,
-               reason           AS reasons,
-               created_at
-        FROM risk_scores
-    """)
-    # derive severity from decision
-    decision_to_sev = {"BLOCK": "CRITICAL", "REVIEW": "WARNING", "ALLOW": "INFO"}
-    scores["severity"] = scores["decision"].map(decision_to_sev).fillna("INFO")
+               quantity, price, notional, currency, kyc_ok, aml_flag, status,
+               rule_score, ml_score, combined_score, decision, reasons,
+               CASE WHEN decision IS NULL    THEN NULL
+                    WHEN decision = 'BLOCK'  THEN 'CRITICAL'
+                    WHEN decision = 'REVIEW' THEN 'WARNING'
+                    ELSE 'INFO'
+               END AS severity
+        FROM trades_scored
+        ORDER BY id DESC
+        LIMIT ?
+    """, get_conn(), params=(ALERT_ROWS_LIMIT,), dtype_backend="pyarrow")
 
     # alerts
-    alerts = read_sql("""
+    alerts = pd.read_sql_query("""
         SELECT created_at AS time, trade_id, severity, message
         FROM alerts
         ORDER BY time DESC
-        LIMIT 2000
-    """)
+        LIMIT ?
+    """, get_conn(), params=(ALERT_ROWS_LIMIT,), dtype_backend="pyarrow")
+
+    # Parse timestamps once per cache fill; both columns are ISO-8601 text (naive, no tz)
+    df["timestamp"] = pd.to_datetime(df["timestamp"], format="ISO8601", errors="coerce", cache=True)
+    alerts["time"] = pd.to_datetime(alerts["time"], format="ISO8601", errors="coerce", cache=True)
+
+    # Low-cardinality text columns -> category (small int codes for filters/grouping)
+    for c in CATEGORY_COLS:
+        if c in df.columns:
+            df[c] = df[c].astype("category")
+
+    return df, alerts
+
+# -------------------- Aggregates (computed in SQLite) --------------------
+@st.cache_data(ttl=5.0)
+def load_kpis() -> dict:
+    row = pd.read_sql_query("""
+        SELECT COUNT(*)                     AS total_deals,
+               COALESCE(SUM(notional), 0.0) AS total_value,
+               COUNT(DISTINCT currency)     AS currencies,
+               COUNT(DISTINCT country)      AS countries,
+               COUNT(DISTINCT counterparty) AS counterparties
+        FROM trades
+    """, get_conn()).iloc[0]
+    kpis = {k: (float(row[k]) if k == "total_value" else int(row[k])) for k in row.index}
+    # trades.timestamp is stored as naive local isoformat(), so compare in that format
+    cutoff = (pd.Timestamp.now() - pd.Timedelta(minutes=15)).isoformat()
+    kpis["last_15m_value"] = float(pd.read_sql_query(
+        "SELECT COALESCE(SUM(notional), 0.0) AS v FROM trades WHERE timestamp >= ?",
+        get_conn(),
+        params=(cutoff,),
+    )["v"].iloc[0])
+    return kpis
+
+@st.cache_data(ttl=5.0)
+def load_by_currency() -> pd.DataFrame:
+    return pd.read_sql_query("""
+        SELECT currency, SUM(notional) AS notional
+        FROM trades
+        GROUP BY currency
+        ORDER BY notional DESC
+    """, get_conn())
+
+@st.cache_data(ttl=5.0)
+def load_by_country(limit: int = 10) -> pd.DataFrame:
+    return pd.read_sql_query("""
+        SELECT country, SUM(notional) AS notional
+        FROM trades
+        GROUP BY country
+        ORDER BY notional DESC
+        LIMIT ?
+    """, get_conn(), params=(limit,))
 
-    return trades, scores, alerts
+@st.cache_data(ttl=5.0)
+def load_decisions() -> pd.DataFrame:
+    return pd.read_sql_query("""
+        SELECT decision, COUNT(*) AS count
+        FROM trades_scored
+        WHERE decision IS NOT NULL
+        GROUP BY decision
+    """, get_conn())
+
+@st.cache_data(ttl=5.0)
+def load_reasons(limit: int = 8) -> pd.DataFrame:
+    # reason is a "; "-joined list -> peel one part off per step with a recursive CTE
+    # (plain text splitting, so quotes/backslashes in producer-supplied values are harmless)
+    return pd.read_sql_query("""
+        WITH RECURSIVE parts(part, rest) AS (
+            SELECT NULL, reasons || ';'
+            FROM trades_scored
+            WHERE reasons IS NOT NULL
+            UNION ALL
+            SELECT substr(rest, 1, instr(rest, ';') - 1), substr(rest, instr(rest, ';') + 1)
+            FROM parts
+            WHERE rest <> ''
+        )
+        SELECT TRIM(part) AS Reason, COUNT(*) AS Count
+        FROM parts
+        WHERE TRIM(part) <> ''
+        GROUP BY TRIM(part)
+        ORDER BY Count DESC
+        LIMIT ?
+    """, get_conn(), params=(limit,))
 
 # -------------------- Load & normalize --------------------
-trades, scores, alerts = load_core()
-df = trades.merge(scores, on="trade_id", how="left")
+df, alerts = load_core()
 
-# Parse timestamps as naive (avoid tz mismatch)
-df["timestamp"] = pd.to_datetime(df["timestamp"], errors="coerce").dt.tz_localize(None)
-alerts["time"] = pd.to_datetime(alerts["time"], errors="coerce").dt.tz_localize(None)
+kpis = load_kpis()
+decisions = load_decisions()
+# small aggregated Series (USD); display conversion is a scalar multiply on these
+by_ccy = load_by_currency().set_index("currency")["notional"]
+by_country = load_by_country().set_index("country")["notional"]
+disp_factor = usd_to_inr if DISPLAY_CCY.startswith("INR") else 1.0
 
 # -------------------- Header --------------------
 if logo:
@@ -126,10 +226,14 @@ with tabs[0]:
 
     # KPI cards
     c1, c2, c3, c4 = st.columns([1.2, 1.2, 1, 1])
-    total_deals = len(df)
-    total_value = df["notional"].sum() if "notional" in df.columns else 0.0
-    review_cnt = int((df["decision"] == "REVIEW").sum()) if "decision" in df.columns else 0
-    critical_cnt = int((df["severity"] == "CRITICAL").sum()) if "severity" in df.columns else 0
+    # one GROUP BY pass in SQL gives every decision count; severity regroups the same counts,
+    # with unknown decisions (e.g. ALERT_FALLBACK:...) counted as INFO like the SQL CASE does
+    dec_counts = decisions.set_index("decision")["count"]
+    sev_counts = dec_counts.groupby(dec_counts.index.map(DEC_SEVERITY).fillna("INFO")).sum()
+    total_deals = kpis["total_deals"]
+    total_value = kpis["total_value"]
+    review_cnt = int(dec_counts.get("REVIEW", 0))
+    critical_cnt = int(sev_counts.get("CRITICAL", 0))
 
     with c1:
         st.metric("Total Deals", f"{total_deals:,}", help="Number of trades processed so far.")
@@ -149,29 +253,26 @@ with tabs[0]:
 
     # Executive Summary (safe markdown)
     st.markdown("### 📌 Executive Summary")
-    now = pd.Timestamp.now()
-    recent = df[df["timestamp"] >= (now - pd.Timedelta(minutes=15))] if "timestamp" in df.columns else df.iloc[0:0]
-    last_15m_value = float(recent["notional"].sum()) if not recent.empty else 0.0
-    top_ccy = (df.groupby("currency")["notional"].sum().sort_values(ascending=False).head(1)
-               if "currency" in df.columns else pd.Series([], dtype=float))
-    top_ccy_label = top_ccy.index[0] if len(top_ccy) else "—"
-    top_ccy_amt   = float(top_ccy.iloc[0]) if len(top_ccy) else 0.0
-    sev_counts = df["severity"].value_counts().to_dict() if "severity" in df.columns else {}
+    last_15m_value = kpis["last_15m_value"]
+    top_ccy_label = by_ccy.index[0] if len(by_ccy) else "—"
+    top_ccy_amt   = float(by_ccy.iloc[0]) if len(by_ccy) else 0.0
 
     summary_md = (
         f"Markets look **stable** overall. "
         f"We processed **{total_deals:,} deals** worth **{money_disp(total_value)}**. "
         f"In the last 15 minutes we saw **{money_disp(last_15m_value)}** of new flow. "
         f"Biggest exposure is in **{top_ccy_label} ({money_disp(top_ccy_amt)})**.\n\n"
-        f"Alert mix: **{sev_counts.get('CRITICAL',0)}** critical, "
-        f"**{sev_counts.get('WARNING',0)}** warning, **{sev_counts.get('INFO',0)}** info."
+        f"Alert mix: **{int(sev_counts.get('CRITICAL',0))}** critical, "
+        f"**{int(sev_counts.get('WARNING',0))}** warning, **{int(sev_counts.get('INFO',0))}** info."
     )
     st.info(summary_md)
 
+    # Charts get only the few-row aggregates above, with every encoding typed so Altair
+    # skips type inference (alt.InlineData is not used: Streamlit's altair hook drops it).
+
     # Decisions pie
-    if "decision" in df.columns and not df["decision"].dropna().empty:
-        pie_src = df.dropna(subset=["decision"]).groupby("decision").size().reset_index(name="count")
-        pie = alt.Chart(pie_src).mark_arc(innerRadius=60).encode(
+    if not decisions.empty:
+        pie = alt.Chart(decisions).mark_arc(innerRadius=60).encode(
             theta="count:Q",
             color=alt.Color("decision:N",
                             scale=alt.Scale(domain=list(DEC_EMOJI.keys()),
@@ -182,16 +283,12 @@ with tabs[0]:
 
     # Top reasons
     st.markdown("### 🔍 What drove today’s risk?")
-    if "reasons" in df.columns and not df["reasons"].dropna().empty:
-        reasons = (
-            df["reasons"].dropna().str.split(";", expand=True).stack().str.strip()
-            .value_counts().reset_index()
-        )
-        reasons.columns = ["Reason", "Count"]
-        bars = alt.Chart(reasons.head(8)).mark_bar().encode(
+    reasons = load_reasons()
+    if not reasons.empty:
+        bars = alt.Chart(reasons).mark_bar().encode(
             x="Count:Q",
             y=alt.Y("Reason:N", sort='-x'),
-            tooltip=["Reason", "Count"]
+            tooltip=["Reason:N", "Count:Q"]
         ).properties(height=260)
         st.altair_chart(bars, use_container_width=True)
     else:
@@ -217,28 +314,24 @@ with tabs[1]:
     st.markdown("## 📊 Our Financial Exposure")
     cA, cB, cC = st.columns(3)
     with cA:
-        st.metric("Currencies Held", df["currency"].nunique() if "currency" in df.columns else 0,
+        st.metric("Currencies Held", kpis["currencies"],
                   help="How many different currencies appear in the book.")
         st.caption("Count of distinct currencies.")
     with cB:
-        st.metric("Countries in Book", df["country"].nunique() if "country" in df.columns else 0,
+        st.metric("Countries in Book", kpis["countries"],
                   help="Number of countries involved in recent trades.")
         st.caption("Distinct countries in activity.")
     with cC:
-        st.metric("Counterparties", df["counterparty"].nunique() if "counterparty" in df.columns else 0,
+        st.metric("Counterparties", kpis["counterparties"],
                   help="Unique trading partners seen in the data.")
         st.caption("Unique partner entities.")
 
     left, right = st.columns(2, gap="large")
     with left:
         st.subheader("By Currency")
-        if "currency" in df.columns and "notional" in df.columns:
+        if not by_ccy.empty:
             # convert for display if INR selected
-            cdf = df.copy()
-            factor = usd_to_inr if DISPLAY_CCY.startswith("INR") else 1.0
-            cdf["notional_display"] = cdf["notional"] * factor
-            ccy = (cdf.groupby("currency")["notional_display"]
-                   .sum().reset_index().sort_values("notional_display", ascending=False))
+            ccy = (by_ccy * disp_factor).rename("notional_display").reset_index()
             if not ccy.empty:
                 chart = alt.Chart(ccy).mark_bar().encode(
                     x=alt.X("currency:N", title="Currency"),
@@ -250,12 +343,8 @@ with tabs[1]:
 
     with right:
         st.subheader("Top Countries")
-        if "country" in df.columns and "notional" in df.columns:
-            factor = usd_to_inr if DISPLAY_CCY.startswith("INR") else 1.0
-            cdf = df.copy()
-            cdf["notional_display"] = cdf["notional"] * factor
-            country = (cdf.groupby("country")["notional_display"]
-                       .sum().reset_index().sort_values("notional_display", ascending=False).head(10))
+        if not by_country.empty:
+            country = (by_country * disp_factor).rename("notional_display").reset_index()
             if not country.empty:
                 chart2 = alt.Chart(country).mark_bar().encode(
                     x=alt.X("notional_display:Q", title=f"Total Value ({'₹' if DISPLAY_CCY.startswith('INR') else '$'})"),
@@ -300,23 +389,16 @@ with tabs[2]:
     px = st.slider("Change in Asset Prices (%)", -30, 30, st.session_state.get("px", 0),
                    help="Simulate a percentage move in asset prices. Negative = price drop.")
 
-    if "currency" in df.columns and "notional" in df.columns:
-        base = (
-            df.groupby("currency")["notional"].sum()
-            .reset_index().rename(columns={"notional": "base"})
-        )
-    else:
-        base = pd.DataFrame(columns=["currency", "base"])
-
     st.caption(f"Δ shows change vs current book. FX: {fx:+d}%  |  Prices: {px:+d}%")
 
-    if not base.empty:
-        # scenario impact on notionals (in USD). For display, convert.
-        base["shock"] = base["base"] * ((100 + fx) / 100.0) * ((100 + px) / 100.0)
-        factor = usd_to_inr if DISPLAY_CCY.startswith("INR") else 1.0
-        disp = base.copy()
-        disp["base"] = disp["base"] * factor
-        disp["shock"] = disp["shock"] * factor
+    if not by_ccy.empty:
+        # scenario impact on notionals: one scalar factor (shock x display conversion), no groupby here
+        scenario = (1 + fx / 100.0) * (1 + px / 100.0)
+        shock_factor = scenario * disp_factor
+        records = [{"currency": c, "base": b * disp_factor, "shock": b * shock_factor}
+                   for c, b in by_ccy.items()]
+        # st.altair_chart drops alt.InlineData values, so hand it the records as a tiny frame
+        disp = pd.DataFrame.from_records(records)
 
         shock_chart = alt.Chart(disp).transform_fold(
             ["base", "shock"], as_=["Scenario", "Value"]
@@ -330,10 +412,10 @@ with tabs[2]:
         ).properties(height=340)
         st.altair_chart(shock_chart, use_container_width=True)
 
-        total_base = float(disp["base"].sum())
-        total_shock = float(disp["shock"].sum())
-        delta = total_shock - total_base
-        pct = (delta / total_base * 100) if total_base else 0.0
+        # P&L in USD; money_disp converts to the display currency exactly once
+        total_base = float(by_ccy.sum())
+        delta = total_base * (scenario - 1.0)
+        pct = (scenario - 1.0) * 100 if total_base else 0.0
         st.metric("Portfolio P&L under Scenario", money_disp(delta),
                   delta=f"{pct:,.2f}%")
 
@@ -357,10 +439,8 @@ with tabs[3]:
     base_cols = ["timestamp", "trade_id", "decision", "severity", "reasons", "combined_score",
                  "counterparty", "currency", "notional", "kyc_ok", "aml_flag", "country"]
     avail = [c for c in base_cols if c in df.columns]
-    df_alerts = df[avail].copy()
-    if "timestamp" in df_alerts.columns:
-        df_alerts.rename(columns={"timestamp": "time"}, inplace=True)
-        df_alerts["time"] = pd.to_datetime(df_alerts["time"], errors="coerce").dt.tz_localize(None)
+    df_alerts = df[avail].rename(columns={"timestamp": "time"})  # timestamp already parsed above
+    if "time" in df_alerts.columns:
         df_alerts = df_alerts.sort_values("time", ascending=False)
 
     # Filters
@@ -373,64 +453,96 @@ with tabs[3]:
         df_alerts = df_alerts[df_alerts["severity"] == sev_filter]
     if "decision" in df_alerts.columns and dec_filter != "All":
         df_alerts = df_alerts[df_alerts["decision"] == dec_filter]
-    if search_txt:
-        mask = False
-        for col in ["trade_id", "reasons", "counterparty"]:
-            if col in df_alerts.columns:
-                m = df_alerts[col].astype(str).str.contains(search_txt, case=False, na=False)
-                mask = m if isinstance(mask, bool) else (mask | m)
-        if not isinstance(mask, bool):
-            df_alerts = df_alerts[mask]
+    search_cols = [c for c in ["trade_id", "reasons", "counterparty"] if c in df_alerts.columns]
+    if search_txt and search_cols:
+        # one haystack column (unit-separator joined) -> one literal search pass
+        hay = df_alerts[search_cols[0]].astype(str).str.cat(
+            [df_alerts[c].astype(str) for c in search_cols[1:]], sep="\x1f", na_rep="")
+        df_alerts = df_alerts[hay.str.contains(search_txt, case=False, regex=False, na=False)]
 
     st.caption(f"Showing {len(df_alerts):,} records")
 
-    # Card view (first 100 for speed)
-    for _, row in df_alerts.head(100).iterrows():
-        header_parts = []
-        if pd.notna(row.get("decision")):
-            header_parts.append(f"{DEC_EMOJI.get(row['decision'],'')} {row['decision']}")
-        if pd.notna(row.get("trade_id")):
-            header_parts.append(str(row["trade_id"]))
-        if pd.notna(row.get("time")):
-            header_parts.append(str(row["time"]))
-        title = " — ".join(header_parts) if header_parts else "Alert"
-
-        with st.expander(title):
-            # Severity badge
-            if pd.notna(row.get("severity")):
-                tag(str(row["severity"]), SEV_COLORS.get(str(row["severity"]), "#495057"))
-
-            # Score
-            if pd.notna(row.get("combined_score")):
-                st.write(f"**Combined Score:** {float(row['combined_score']):.2f}")
-
-            # Explainability chips
-            st.write("**Why this alert?**")
-            chips = [r.strip() for r in str(row.get("reasons", "") or "").split(";") if r and r.strip()]
-            if chips:
-                for ch in chips:
-                    tag(ch, "#364fc7")
-            else:
-                st.caption("No rule violations. Likely ML anomaly or threshold.")
-
-            # Quick context
-            c1, c2, c3, c4 = st.columns(4)
-            c1.metric("Counterparty", str(row.get("counterparty", "-")))
-            c2.metric("Currency", str(row.get("currency", "-")))
-            c3.metric("Notional", money_disp(row.get("notional", 0)))
-            kyc = row.get("kyc_ok", 0)
-            aml = row.get("aml_flag", 0)
-            try:
-                kyc_txt = "✅" if int(kyc) == 1 else "❌"
-            except Exception:
-                kyc_txt = "—"
-            try:
-                aml_txt = "🚩" if int(aml) == 1 else "—"
-            except Exception:
-                aml_txt = "—"
-            c4.metric("KYC / AML", f"{kyc_txt} / {aml_txt}")
-            if pd.notna(row.get("country")):
-                st.caption(f"Country: {row['country']}")
+    # First 100 rows for speed — build every display string column-wise up front
+    top = df_alerts.head(100).reset_index(drop=True).reindex(columns=["time"] + base_cols[1:])
+    top = top.astype({c: object for c in top.columns if c in CATEGORY_COLS})  # plain strings for formatting
+
+    top["decision_disp"] = top["decision"].map(DEC_EMOJI).fillna("") + " " + top["decision"]
+    top["severity_disp"] = top["severity"].map(SEV_EMOJI).fillna("") + " " + top["severity"]
+    top["notional_disp"] = money_series(top["notional"])
+    kyc = pd.to_numeric(top["kyc_ok"], errors="coerce").astype("float64")  # NA -> NaN for np.where
+    aml = pd.to_numeric(top["aml_flag"], errors="coerce").astype("float64")
+    kyc_txt = np.where(kyc.eq(1), "✅", np.where(kyc.isna(), "—", "❌"))
+    aml_txt = np.where(aml.eq(1), "🚩", "—")
+    top["kyc_aml"] = pd.Series(kyc_txt, index=top.index) + " / " + aml_txt
+    for col in ["counterparty", "currency"]:
+        top[col] = top[col].fillna("-").astype(str)
+    top["reasons_missing"] = top["reasons"].isna() & top["decision"].eq("ALLOW")
+
+    if st.toggle("Detailed card view", help="One expandable card per alert (slower to render)."):
+        time_part = top["time"].astype(str).where(top["time"].notna())
+        title_parts = pd.concat([top["decision_disp"], top["trade_id"].astype(str).where(top["trade_id"].notna()),
+                                 time_part], axis=1)
+        top["title"] = (title_parts.stack().groupby(level=0).agg(" — ".join)
+                        .reindex(top.index, fill_value="Alert"))
+        top["sev_color"] = top["severity"].map(SEV_COLORS).fillna("#495057")
+        top["score_txt"] = top["combined_score"].map("**Combined Score:** {:.2f}".format, na_action="ignore")
+        chips = top["reasons"].dropna().astype(str).str.split(";").explode().str.strip()
+        chips_by_row = chips.loc[lambda c: c != ""].groupby(level=0).agg(list).to_dict()
+        top["chips"] = [chips_by_row.get(i, []) for i in top.index]
+
+        for r in top.itertuples(index=False):
+            with st.expander(r.title):
+                # Severity badge
+                if pd.notna(r.severity):
+                    tag(str(r.severity), r.sev_color)
+
+                # Score
+                if pd.notna(r.score_txt):
+                    st.write(r.score_txt)
+
+                # Explainability chips
+                st.write("**Why this alert?**")
+                if r.chips:
+                    for ch in r.chips:
+                        tag(ch, "#364fc7")
+                elif r.reasons_missing:
+                    st.caption(ALLOW_REASONS_MISSING)
+                else:
+                    st.caption("No rule violations. Likely ML anomaly or threshold.")
+
+                # Quick context
+                c1, c2, c3, c4 = st.columns(4)
+                c1.metric("Counterparty", r.counterparty)
+                c2.metric("Currency", r.currency)
+                c3.metric("Notional", r.notional_disp)
+                c4.metric("KYC / AML", r.kyc_aml)
+                if pd.notna(r.country):
+                    st.caption(f"Country: {r.country}")
+    else:
+        # Grid view: one component for all rows
+        scores_f = top["combined_score"].astype("float64")
+        score_max = max(1.5, float(scores_f.max())) if scores_f.notna().any() else 1.5
+        top["reasons"] = top["reasons"].mask(top["reasons_missing"], ALLOW_REASONS_MISSING)
+        st.dataframe(
+            top[["time", "decision_disp", "severity_disp", "trade_id", "combined_score", "reasons",
+                 "counterparty", "currency", "notional_disp", "kyc_aml", "country"]],
+            column_config={
+                "time": st.column_config.DatetimeColumn("Time", format="YYYY-MM-DD HH:mm:ss"),
+                "decision_disp": st.column_config.TextColumn("Decision"),
+                "severity_disp": st.column_config.TextColumn("Severity"),
+                "trade_id": st.column_config.TextColumn("Deal ID"),
+                "combined_score": st.column_config.ProgressColumn(
+                    "Combined Score", format="%.2f", min_value=0.0, max_value=score_max),
+                "reasons": st.column_config.TextColumn("Why this alert?"),
+                "counterparty": st.column_config.TextColumn("Counterparty"),
+                "currency": st.column_config.TextColumn("Currency"),
+                "notional_disp": st.column_config.TextColumn("Notional"),
+                "kyc_aml": st.column_config.TextColumn("KYC / AML"),
+                "country": st.column_config.TextColumn("Country"),
+            },
+            hide_index=True,
+            use_container_width=True,
+        )
 
     # Download the currently filtered view
     st.download_button(
@@ -2,7 +2,20 @@ import sqlite3, pandas as pd, os
 
 DB_PATH = "risk_demo.sqlite"
 
+# also created by dashboard.get_conn(), so DBs initialised before the view existed still work
+TRADES_SCORED_VIEW = """CREATE VIEW IF NOT EXISTS trades_scored AS
+SELECT t.*,
+       r.base_rule_score  AS rule_score,
+       r.ml_anomaly_score AS ml_score,
+       r.combined_score,
+       r.decision,
+       r.reason           AS reasons
+FROM trades t
+LEFT JOIN risk_scores r ON r.trade_id = t.trade_id"""
+
 schema_sql = """
+-- persists in the DB file; synchronous/temp_store/mmap_size are per-connection settings,
+-- so the processor, generator and dashboard set the ones they need on their own connections
 PRAGMA journal_mode=WAL;
 
 CREATE TABLE IF NOT EXISTS counterparties(
@@ -63,6 +76,25 @@ CREATE TABLE IF NOT EXISTS alerts(
   message TEXT,
   created_at TEXT DEFAULT (datetime('now'))
 );
+
+-- indexes for the dashboard queries
+CREATE INDEX IF NOT EXISTS idx_trades_ts ON trades(timestamp);
+
+CREATE INDEX IF NOT EXISTS idx_trades_ccy ON trades(currency);
+
+CREATE INDEX IF NOT EXISTS idx_trades_country ON trades(country);
+
+-- DBs scored before the unique index may hold repeated trade_ids: keep the first score of each
+DELETE FROM risk_scores
+WHERE trade_id IS NOT NULL
+  AND id NOT IN (SELECT MIN(id) FROM risk_scores WHERE trade_id IS NOT NULL GROUP BY trade_id);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_rs_tid ON risk_scores(trade_id);
+
+CREATE INDEX IF NOT EXISTS idx_alerts_time ON alerts(created_at DESC);
+
+-- trades joined to their score, used by the dashboard
+""" + TRADES_SCORED_VIEW + """;
 """
 
 def seed_reference_data(conn: sqlite3.Connection):
@@ -85,22 +117,32 @@ def seed_reference_data(conn: sqlite3.Connection):
         ("REQUIRE_KYC", 1.0, "TRUE"),
         ("AML_FLAG_BLOCK", 1.0, "TRUE")
     ]
-    conn.executemany("INSERT INTO rules(rule_name,threshold,param,active) VALUES (?,?,?,1)", rules)
+    # insert-if-missing, so re-running db_init doesn't double every rule (or sanction)
+    conn.executemany("""INSERT INTO rules(rule_name,threshold,param,active)
+        SELECT ?1,?2,?3,1 WHERE NOT EXISTS (SELECT 1 FROM rules WHERE rule_name=?1)""", rules)
 
     # sanctions
     sanctions_path = os.path.join("data", "sanctions_list.csv")
     if os.path.exists(sanctions_path):
         df = pd.read_csv(sanctions_path)
         for _,r in df.iterrows():
-            conn.execute("INSERT INTO sanctions(name,country) VALUES (?,?)", (str(r['name']), str(r['country'])))
+            conn.execute("""INSERT INTO sanctions(name,country)
+                SELECT ?1,?2 WHERE NOT EXISTS (SELECT 1 FROM sanctions WHERE name=?1 AND country=?2)""",
+                (str(r['name']), str(r['country'])))
 
 def main():
     conn = sqlite3.connect(DB_PATH)
     for stmt in schema_sql.split(";\n\n"):
         s = stmt.strip()
         if s:
-            conn.execute(s)
+            cur = conn.execute(s)
+            if "DELETE FROM risk_scores" in s and cur.rowcount > 0:
+                print(f"Removed {cur.rowcount} duplicate risk_scores rows (kept the first per trade_id)")
     seed_reference_data(conn)
+    # same bump as risk_engine.bump_rules_version (inlined so init needs no sklearn/joblib):
+    # running processors pick up the (re)seeded rules/sanctions
+    version = conn.execute("PRAGMA user_version").fetchone()[0] + 1
+    conn.execute(f"PRAGMA user_version = {version}")
     conn.commit()
     conn.close()
     print("SQLite DB initialized at", DB_PATH)
@@ -1,37 +1,53 @@
-import time, random, sqlite3, pandas as pd, numpy as np
+import os, time, random, sqlite3, pandas as pd, numpy as np
 
 DB_PATH = "risk_demo.sqlite"
 SEED_DATA = "data/seed_trades.csv"
+BATCH_SIZE = 5   # trades written per transaction
+TICK_S = 5.0     # seconds between batches: ~1 trade per second as documented
+                 # (5x the old one-at-a-time loop, which actually slept 5 s per trade)
+RUN_TAG = os.getpid()  # keeps ids apart across generator instances / restarts within one second
+
+INSERT_SQL = """INSERT INTO trades
+    (trade_id,timestamp,counterparty,sector,country,symbol,trade_type,quantity,price,notional,currency,kyc_ok,aml_flag,status)
+    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)"""
 
 def main():
     df = pd.read_csv(SEED_DATA)
-    conn = sqlite3.connect(DB_PATH, isolation_level=None)  # autocommit
+    conn = sqlite3.connect(DB_PATH, isolation_level="")  # deferred transactions, committed per batch
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
     cur = conn.cursor()
 
-    i = 0
     print("Starting trade generation. Ctrl+C to stop.")
     while True:
-        r = df.sample(1, replace=True).iloc[0].to_dict()
-        # add some randomness
-        mult = np.clip(np.random.normal(1.0, 0.2), 0.5, 2.5)
-        r["quantity"] = max(1, int(r["quantity"] * mult))
-        r["price"] = round(max(0.5, r["price"] * np.clip(np.random.normal(1.0,0.1), 0.7, 1.4)), 2)
-        r["notional"] = round(r["quantity"] * r["price"], 2)
-        r["trade_id"] = f"SIM{int(time.time())}{random.randint(100,999)}"
-        r["timestamp"] = pd.Timestamp.now().isoformat()
-        r["status"] = "NEW"
+        batch = df.sample(BATCH_SIZE, replace=True)
+        # add some randomness (one draw per batch)
+        mult = np.clip(np.random.normal(1.0, 0.2, size=BATCH_SIZE), 0.5, 2.5)
+        px_mult = np.clip(np.random.normal(1.0, 0.1, size=BATCH_SIZE), 0.7, 1.4)
+        quantity = np.maximum(1, (batch["quantity"].to_numpy() * mult).astype(np.int64))
+        price = np.round(np.maximum(0.5, batch["price"].to_numpy() * px_mult), 2)
+        notional = np.round(quantity * price, 2)
+        # distinct suffixes so a batch's trade_ids can't collide within the same second
+        now_s = int(time.time())
+        trade_ids = [f"SIM{now_s}{RUN_TAG}{k}" for k in random.sample(range(100, 1000), BATCH_SIZE)]
+        # one timestamp per trade, spread over the tick as if they arrived one by one
+        now = pd.Timestamp.now()
+        step = pd.Timedelta(seconds=TICK_S / BATCH_SIZE)
+        ts = [(now - step * (BATCH_SIZE - 1 - i)).isoformat() for i in range(BATCH_SIZE)]
+
+        rows = list(zip(
+            trade_ids, ts, batch["counterparty"], batch["sector"], batch["country"],
+            batch["symbol"], batch["trade_type"], quantity.tolist(), price.tolist(),
+            notional.tolist(), batch["currency"], batch["kyc_ok"].astype(int).tolist(),
+            batch["aml_flag"].astype(int).tolist(), ["NEW"] * BATCH_SIZE,
+        ))
 
-        cur.execute(
-            """INSERT INTO trades
-            (trade_id,timestamp,counterparty,sector,country,symbol,trade_type,quantity,price,notional,currency,kyc_ok,aml_flag,status)
-            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)""", (
-                r["trade_id"], r["timestamp"], r["counterparty"], r["sector"], r["country"],
-                r["symbol"], r["trade_type"], int(r["quantity"]), float(r["price"]),
-                float(r["notional"]), r["currency"], int(r["kyc_ok"]), int(r["aml_flag"]), r["status"]
-            )
-        )
-        print("Inserted trade", r["trade_id"], "notional", r["notional"])
-        time.sleep(5.0)  # one per second
+        # one transaction (one fsync) per batch instead of one per row
+        cur.executemany(INSERT_SQL, rows)
+        conn.commit()
+        for row in rows:
+            print("Inserted trade", row[0], "notional", row[9])
+        time.sleep(TICK_S)
 
 if __name__ == "__main__":
     main()
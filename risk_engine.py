@@ -1,54 +1,303 @@
-import re, sqlite3, pickle, numpy as np
+import os, re, sqlite3, joblib, numpy as np, pandas as pd
+from collections import namedtuple
+from functools import lru_cache
+from operator import attrgetter
+from typing import Dict, List, Optional, Tuple
 
-MODEL_PATH = "model_isoforest.pkl"
+DB_PATH = "risk_demo.sqlite"
+MODEL_PATH = "model_isoforest.joblib"
+FLAT_MODEL_PATH = "model_isoforest_flat.joblib"
+LEGACY_MODEL_PATH = "model_isoforest.pkl"  # pickle written by older train_anomaly_model.py
 FEATURES = ["quantity","price","notional"]
 
+# one fetched trades row; the processor SELECTs exactly these columns
+TRADE_FIELDS = [
+    "id","trade_id","timestamp","counterparty","sector","country","symbol","trade_type",
+    "quantity","price","notional","currency","kyc_ok","aml_flag"
+]
+Trade = namedtuple("Trade", TRADE_FIELDS)
+_FEATURE_GETTERS = [attrgetter(f) for f in FEATURES]
+
+def _as_trade(trade) -> Trade:
+    """Trade rows pass through; dicts (one-off callers, DataFrame records) map missing fields to None."""
+    if isinstance(trade, Trade):
+        return trade
+    return Trade._make(trade.get(f) for f in TRADE_FIELDS)
+
+def _feature_matrix(rows: List[Trade]) -> np.ndarray:
+    # float32 is what the trees compare against anyway, so build it directly
+    return np.asarray([[get(r) for get in _FEATURE_GETTERS] for r in rows],
+                      dtype=np.float32).reshape(-1, len(FEATURES))
+
+def _average_path_length(n: float) -> float:
+    """c(n): average path length of an unsuccessful BST search over n points, as sklearn's
+    IsolationForest normalises depths (copied so importing this module needs no sklearn internals)."""
+    n = float(n)
+    if n <= 1:
+        return 0.0
+    if n == 2:
+        return 1.0
+    return float(2.0 * (np.log(n - 1.0) + np.euler_gamma) - 2.0 * (n - 1.0) / n)
+
+class FlatForest:
+    """Fitted IsolationForest flattened into stacked node arrays.
+
+    score_samples() walks every tree for the whole batch at once, one tree level per
+    NumPy step, and matches sklearn's IsolationForest.score_samples bit for bit.
+    Past a few hundred rows the gathers cost more than sklearn's per-tree apply(), so
+    big catch-up batches go back to the wrapped model when there is one.
+    """
+
+    MAX_ROWS = 256
+    ARRAYS = ("feature", "threshold", "child", "leaf_value", "roots", "max_depth", "denominator")
+
+    def __init__(self, arrays: dict, model=None):
+        self.model = model
+        self.feature = np.asarray(arrays["feature"], dtype=np.intp)
+        self.threshold = np.asarray(arrays["threshold"], dtype=np.float64)
+        self.child = np.asarray(arrays["child"], dtype=np.intp)
+        self.leaf_value = np.asarray(arrays["leaf_value"], dtype=np.float64)
+        self.roots = np.asarray(arrays["roots"], dtype=np.intp)
+        self.max_depth = int(arrays["max_depth"])
+        self.denominator = float(arrays["denominator"])
+        # reusable feature-major input buffer: x[f, i] = _x_buf[f*MAX_ROWS + i], offsets fixed up front
+        self._x_buf = np.empty((len(FEATURES), self.MAX_ROWS), dtype=np.float32)
+        self._x_buf_off = self.feature * self.MAX_ROWS
+
+    # fitted-forest internals from_model reads (private to sklearn, checked so a version bump fails clearly)
+    MODEL_ATTRS = ("estimators_", "estimators_features_", "_decision_path_lengths",
+                   "_average_path_length_per_tree", "_max_samples")
+
+    @classmethod
+    def from_model(cls, model) -> "FlatForest":
+        missing = [a for a in cls.MODEL_ATTRS if not hasattr(model, a)]
+        if missing:
+            raise TypeError(f"cannot flatten {type(model).__name__}: fitted IsolationForest attributes "
+                            f"missing ({', '.join(missing)}); this sklearn version is not supported")
+        feature, threshold, child, leaf_value, roots = [], [], [], [], []
+        offset, max_depth = 0, 0
+        for est, feats, dpl, apl in zip(model.estimators_, model.estimators_features_,
+                                        model._decision_path_lengths,
+                                        model._average_path_length_per_tree):
+            t = est.tree_
+            nodes = np.arange(t.node_count)
+            is_leaf = t.children_left < 0
+            # leaves loop onto themselves so a fixed number of steps lands everyone on a leaf
+            feature.append(np.where(is_leaf, 0, np.asarray(feats)[np.maximum(t.feature, 0)]))
+            threshold.append(t.threshold)
+            # child[2*node + go_left] -> next node
+            child.append(np.stack([np.where(is_leaf, nodes, t.children_right),
+                                   np.where(is_leaf, nodes, t.children_left)], axis=1).ravel() + offset)
+            leaf_value.append(dpl + apl - 1.0)  # same per-tree depth term sklearn accumulates
+            roots.append(offset)
+            offset += t.node_count
+            max_depth = max(max_depth, t.max_depth)
+        return cls({
+            "feature": np.concatenate(feature),
+            "threshold": np.concatenate(threshold),
+            "child": np.concatenate(child),
+            "leaf_value": np.concatenate(leaf_value),
+            "roots": roots,
+            "max_depth": max_depth,
+            "denominator": len(model.estimators_) * _average_path_length(model._max_samples),
+        }, model)
+
+    def save(self, path: str) -> None:
+        # uncompressed, so load() can memory-map the node arrays instead of reading them in
+        joblib.dump({k: getattr(self, k) for k in self.ARRAYS}, path, compress=0)
+
+    @classmethod
+    def load(cls, path: str) -> "FlatForest":
+        # read-only mmap: near-instant load, and processors on one host share the page cache
+        return cls(joblib.load(path, mmap_mode="r"))
+
+    def score_samples(self, X) -> np.ndarray:
+        n = len(X)
+        if n > self.MAX_ROWS and self.model is not None:
+            return self.model.score_samples(X)
+        X = np.asarray(X, dtype=np.float32)  # sklearn trees split on float32 inputs
+        flat_x = np.ascontiguousarray(X.T).ravel()  # feature-major, so x[f, i] = flat_x[f*n + i]
+        return self._walk(flat_x, self.feature * n, n)
+
+    def score_rows(self, rows: List[Trade]) -> np.ndarray:
+        """score_samples() for Trade rows, filled straight into the preallocated float32 buffer."""
+        n = len(rows)
+        if n == 0 or n > self.MAX_ROWS:
+            return self.score_samples(_feature_matrix(rows))
+        buf = self._x_buf
+        for j, get in enumerate(_FEATURE_GETTERS):
+            buf[j, :n] = [get(r) for r in rows]
+        return self._walk(buf.ravel(), self._x_buf_off, n)
+
+    def _walk(self, flat_x: np.ndarray, feature_off: np.ndarray, n: int) -> np.ndarray:
+        cols = np.arange(n)
+        node = np.repeat(self.roots[:, None], n, axis=1)  # (n_trees, n_rows)
+        for _ in range(self.max_depth):
+            go_left = flat_x[feature_off[node] + cols] <= self.threshold[node]
+            node = self.child[2 * node + go_left]
+        # tree-by-tree adds like sklearn; cumsum stays sequential even for n == 1, where sum() goes pairwise
+        depths = np.cumsum(self.leaf_value[node], axis=0)[-1]
+        if self.denominator == 0:
+            # single training sample: sklearn sets the exponent to 1 (np.divide out=ones), not the score
+            return -np.full_like(depths, 0.5)
+        return -(2 ** (-depths / self.denominator))
+
 def load_model():
-    with open(MODEL_PATH, "rb") as f:
-        return pickle.load(f)
+    # the flattened forest written by train_anomaly_model.py needs no sklearn objects at all;
+    # fall back to the full sklearn model (or the legacy .pkl) when it is missing or older than that model
+    if os.path.exists(FLAT_MODEL_PATH) and (
+            not os.path.exists(MODEL_PATH) or os.path.getmtime(FLAT_MODEL_PATH) >= os.path.getmtime(MODEL_PATH)):
+        return FlatForest.load(FLAT_MODEL_PATH)
+    if os.path.exists(MODEL_PATH):
+        model = joblib.load(MODEL_PATH, mmap_mode="r")
+    else:
+        # installs trained before the joblib switch: joblib.load reads a plain pickle too
+        model = joblib.load(LEGACY_MODEL_PATH)
+    # batches are small: joblib worker dispatch costs more than the trees themselves
+    model.set_params(n_jobs=1)
+    return FlatForest.from_model(model)
 
-def rule_based_score(trade: dict, conn: sqlite3.Connection):
-    score = 0.0
-    reasons = []
-
-    # Load active rules
-    cur = conn.execute("SELECT rule_name, threshold, param FROM rules WHERE active=1")
-    rules = cur.fetchall()
-
-    for rule_name, threshold, param in rules:
-        if rule_name == "MAX_NOTIONAL":
-            max_notional = float(threshold)
-            if float(trade["notional"]) > max_notional:
-                score += 0.6
-                reasons.append(f"Notional {trade['notional']} > {max_notional}")
-        elif rule_name == "BLACKLIST_COUNTRY":
-            pattern = param
-            if re.search(pattern, str(trade["country"])):
-                score += 0.8
-                reasons.append(f"Blacklisted country: {trade['country']}")
-        elif rule_name == "REQUIRE_KYC":
-            if int(trade.get("kyc_ok",0)) != 1:
-                score += 0.7
+class RiskEngine:
+    """Active rules + sanctions read once from the DB, then evaluated in memory."""
+
+    SANCTIONS_BIT = 1 << 31  # reason bit i (< 31) = self._checks[i] fired
+
+    def __init__(self, conn: sqlite3.Connection):
+        # read first, so a bump racing with the SELECTs below still triggers a reload next batch
+        self.rules_version = _rules_version(conn)
+        rules = conn.execute("SELECT rule_name, threshold, param FROM rules WHERE active=1").fetchall()
+        # compiled checks, kept in table order so scores/reasons add up exactly as before
+        self._checks = []
+        for rule_name, threshold, param in rules:
+            if rule_name == "MAX_NOTIONAL":
+                self._checks.append((rule_name, float(threshold)))
+            elif rule_name == "BLACKLIST_COUNTRY":
+                self._checks.append((rule_name, re.compile(param)))
+            elif rule_name in ("REQUIRE_KYC", "AML_FLAG_BLOCK"):
+                self._checks.append((rule_name, None))
+        if len(self._checks) >= 31:
+            raise ValueError(f"too many active rules for the reason bitmask: {len(self._checks)}")
+        self._sanctions = frozenset(str(name).lower() for (name,) in conn.execute("SELECT name FROM sanctions"))
+        self._country_hits: Dict[Tuple[int, str], bool] = {}  # (check index, country) -> regex hit
+
+    def score(self, trade: dict):
+        trade = _as_trade(trade)
+        scores, bits = self.score_rows([trade])
+        return float(scores[0]), self.reasons(int(bits[0]), trade)
+
+    def score_rows(self, trades: List[Trade]) -> Tuple[np.ndarray, np.ndarray]:
+        """Whole-batch rule pass -> (float64 scores, uint32 reason bitmasks); no strings built."""
+        n = len(trades)
+        scores = np.zeros(n, dtype=np.float64)
+        bits = np.zeros(n, dtype=np.uint32)
+        if n == 0:
+            return scores, bits
+
+        for i, (rule_name, arg) in enumerate(self._checks):
+            if rule_name == "MAX_NOTIONAL":
+                hit = _column(trades, "notional") > arg
+                weight = 0.6
+            elif rule_name == "BLACKLIST_COUNTRY":
+                hit = np.fromiter((self._country_hit(i, arg, t.country) for t in trades), bool, n)
+                weight = 0.8
+            elif rule_name == "REQUIRE_KYC":
+                hit = _column(trades, "kyc_ok") != 1  # missing KYC counts as not verified
+                weight = 0.7
+            else:  # AML_FLAG_BLOCK
+                hit = _column(trades, "aml_flag") == 1
+                weight = 1.0
+            # same add order as rule-by-rule scoring, so float sums are unchanged
+            scores[hit] += weight
+            bits[hit] |= np.uint32(1 << i)
+        # sanctions name match (toy)
+        hit = np.fromiter((str(t.counterparty).lower() in self._sanctions for t in trades), bool, n)
+        scores[hit] += 1.2
+        bits[hit] |= np.uint32(self.SANCTIONS_BIT)
+
+        return scores, bits
+
+    def reasons(self, bits: int, trade: Trade) -> List[str]:
+        """Reason strings for one trade's bitmask, in rule order."""
+        reasons = []
+        for i, (rule_name, arg) in enumerate(self._checks):
+            if not bits >> i & 1:
+                continue
+            if rule_name == "MAX_NOTIONAL":
+                reasons.append(f"Notional {trade.notional} > {arg}")
+            elif rule_name == "BLACKLIST_COUNTRY":
+                reasons.append(f"Blacklisted country: {trade.country}")
+            elif rule_name == "REQUIRE_KYC":
                 reasons.append("KYC not verified")
-        elif rule_name == "AML_FLAG_BLOCK":
-            if int(trade.get("aml_flag",0)) == 1:
-                score += 1.0
+            elif rule_name == "AML_FLAG_BLOCK":
                 reasons.append("AML system flagged")
-        # sanctions name match (toy)
-    # quick sanctions join
-    cur2 = conn.execute("SELECT name FROM sanctions")
-    sanc_names = [r[0].lower() for r in cur2.fetchall()]
-    if str(trade["counterparty"]).lower() in sanc_names:
-        score += 1.2
-        reasons.append("Counterparty on sanctions list")
+        if bits & self.SANCTIONS_BIT:
+            reasons.append("Counterparty on sanctions list")
+        return reasons
 
-    return score, reasons
+    def score_batch(self, trades_df: pd.DataFrame):
+        """score() over a DataFrame of trades -> (scores ndarray, list of reason lists)."""
+        trades = [_as_trade(t) for t in trades_df.to_dict("records")]
+        scores, bits = self.score_rows(trades)
+        return scores, [self.reasons(int(b), t) for b, t in zip(bits, trades)]
 
-def ml_anomaly_score(trade: dict, model):
-    x = np.array([[float(trade["quantity"]), float(trade["price"]), float(trade["notional"])]], dtype=float)
+    def _country_hit(self, i: int, pattern: re.Pattern, country) -> bool:
+        key = (i, str(country))
+        hit = self._country_hits.get(key)
+        if hit is None:
+            hit = self._country_hits[key] = pattern.search(key[1]) is not None
+        return hit
+
+def _column(trades: List[Trade], key: str) -> np.ndarray:
+    # None (SQL NULL) -> NaN, which fails every == / > comparison
+    get = attrgetter(key)
+    return np.array([get(t) for t in trades], dtype=np.float64)
+
+def _rules_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def bump_rules_version(conn: sqlite3.Connection) -> int:
+    """Call after editing rules/sanctions so running processors reload them on their next batch."""
+    version = _rules_version(conn) + 1
+    conn.execute(f"PRAGMA user_version = {version}")
+    return version
+
+def rule_context(conn: sqlite3.Connection, current: Optional[RiskEngine] = None) -> RiskEngine:
+    """`current` while PRAGMA user_version is unchanged, else a RiskEngine freshly loaded from the DB."""
+    if current is not None and _rules_version(conn) == current.rules_version:
+        return current
+    return RiskEngine(conn)
+
+def _db_mtime(conn: sqlite3.Connection) -> Optional[float]:
+    """mtime of the file `conn` has open as "main" (None for in-memory/temp DBs)."""
+    path = next((row[2] for row in conn.execute("PRAGMA database_list") if row[1] == "main"), "")
+    if not path:
+        return None
+    # with WAL, commits land in the -wal file until a checkpoint, so watch both
+    paths = (path, path + "-wal")
+    return max((os.path.getmtime(p) for p in paths if os.path.exists(p)), default=0.0)
+
+@lru_cache(maxsize=1)
+def _engine_snapshot(conn: sqlite3.Connection, db_mtime: float) -> RiskEngine:
+    # rules + sanctions are re-read only when the DB file changes
+    return RiskEngine(conn)
+
+def rule_based_score(trade: dict, conn: sqlite3.Connection):
+    db_mtime = _db_mtime(conn)
+    if db_mtime is None:
+        return RiskEngine(conn).score(trade)  # no file to watch, so nothing safe to cache on
+    return _engine_snapshot(conn, db_mtime).score(trade)
+
+def _anomaly_from_raw(raw: np.ndarray) -> np.ndarray:
     # IsolationForest: decision_function -> higher is more normal; score_samples lower is more anomalous
-    raw = model.score_samples(x)[0]  # negative is more anomalous
     # Convert to [0..1] where 1 = very anomalous
     # min-max like mapping with a sigmoid-ish transform
-    anom = 1 / (1 + np.exp(5 * raw))  # raw usually ~[-1.0..0.2]
-    return float(anom)
+    return 1.0 / (1.0 + np.exp(5.0 * raw))  # raw usually ~[-1.0..0.2]
+
+def ml_anomaly_score_batch(rows: List[Trade], model) -> np.ndarray:
+    """One scoring call for a list of Trade rows -> anomaly score per row."""
+    if isinstance(model, FlatForest):
+        return _anomaly_from_raw(model.score_rows(rows))
+    return _anomaly_from_raw(model.score_samples(_feature_matrix(rows)))
+
+def ml_anomaly_score(trade: dict, model):
+    return float(ml_anomaly_score_batch([_as_trade(trade)], model)[0])
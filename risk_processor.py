@@ -1,7 +1,8 @@
 # risk_processor.py
 # ------------------------------------------------------------------
 # Polls NEW trades, scores them (rules + ML), writes to DB, logs alerts.
-# - Translates "reasons" to banker-friendly phrases
+# - Translates "reasons" to banker-friendly phrases and raises alerts for REVIEW/BLOCK
+#   (ALLOW trades get no alert and a NULL reason unless DEBUG logging is on: RISK_LOG_LEVEL=DEBUG)
 # - Auto-detects risk_scores schema:
 #     A) rule_score, ml_score, combined_score, decision, severity, reasons
 #     B) base_rule_score, ml_anomaly_score, combined_score, decision, reason
@@ -10,14 +11,32 @@
 #     B) ... severity ...
 # ------------------------------------------------------------------
 
+import os
+import sys
+import ctypes
 import time
+import queue
+import logging
+import logging.handlers
 import sqlite3
+import threading
 import warnings
-from typing import Dict, List, Tuple
+from typing import List, Optional, Tuple
 
-from risk_engine import load_model, rule_based_score, ml_anomaly_score
+from risk_engine import TRADE_FIELDS, RiskEngine, Trade, load_model, ml_anomaly_score_batch, rule_context
 
 DB_PATH = "risk_demo.sqlite"
+IDLE_POLL_S = 0.25     # PRAGMA data_version check interval while idle
+IDLE_TIMEOUT_S = 30.0  # re-check for NEW rows at least this often regardless
+WRITER_QUEUE_JOBS = 16  # ~4 batches (3 statements + COMMIT each) queued ahead of the writer at most
+# optional custom VFS (e.g. an io_uring-backed build): extension that registers it + its name.
+# Either may be set alone: an extension that registers itself as the default VFS needs no
+# name, and a built-in VFS (e.g. unix-excl) needs no extension
+SQLITE_VFS_EXTENSION = os.environ.get("RISK_SQLITE_VFS_EXTENSION")
+SQLITE_VFS = os.environ.get("RISK_SQLITE_VFS")
+LOG_LEVEL = (os.environ.get("RISK_LOG_LEVEL") or "INFO").upper()  # DEBUG also explains/alerts ALLOW trades
+
+log = logging.getLogger("risk")
 
 # Cosmetic: hide IsolationForest "feature names" warning
 warnings.filterwarnings(
@@ -26,6 +45,24 @@ warnings.filterwarnings(
 )
 
 # ---------- generic helpers ----------
+def _start_logging() -> logging.handlers.QueueListener:
+    """Log records go onto a queue; a listener thread does the actual stdout writes."""
+    records: "queue.Queue[logging.LogRecord]" = queue.Queue()
+    level = logging.getLevelNamesMapping().get(LOG_LEVEL)
+    log.setLevel(logging.INFO if level is None else level)
+    log.addHandler(logging.handlers.QueueHandler(records))
+    log.propagate = False
+    listener = logging.handlers.QueueListener(records, logging.StreamHandler(sys.stdout))
+    listener.start()
+    if level is None:
+        log.warning(f"Unknown RISK_LOG_LEVEL {LOG_LEVEL!r}; logging at INFO.")
+    return listener
+
+def _log_decisions(messages: List[str]) -> None:
+    # one record per batch, and no joining at all when INFO is off
+    if messages and log.isEnabledFor(logging.INFO):
+        log.info("\n".join(messages))
+
 def _table_columns(conn: sqlite3.Connection, table: str) -> List[str]:
     rows = conn.execute(f"PRAGMA table_info({table})").fetchall()
     return [r[1] for r in rows]  # column names
@@ -38,164 +75,318 @@ def _decide(combined_score: float) -> Tuple[str, str]:
     else:
         return "ALLOW", "INFO"
 
+TRANSLATE = {
+    "Notional {val} > {thr}": "Deal is bigger than our limit",
+    "Country in blacklist": "Counterparty country is restricted",
+    "KYC missing": "KYC not completed",
+    "AML flag present": "AML system has red flags",
+    "Sanctions name match": "Possible sanctions list match",
+}
+# precomputed once: (prefix, pretty) pairs, indexed by the prefix's first word
+_TRANSLATE_PREFIXES = tuple((k.split("{")[0].strip(), v) for k, v in TRANSLATE.items())
+_TRANSLATE_BY_FIRSTWORD = {prefix.split()[0]: (prefix, v) for prefix, v in _TRANSLATE_PREFIXES}
+
 def _translate_reasons(raw_reasons: List[str]) -> List[str]:
-    TRANSLATE = {
-        "Notional {val} > {thr}": "Deal is bigger than our limit",
-        "Country in blacklist": "Counterparty country is restricted",
-        "KYC missing": "KYC not completed",
-        "AML flag present": "AML system has red flags",
-        "Sanctions name match": "Possible sanctions list match",
-    }
     pretty: List[str] = []
     for r in (raw_reasons or []):
-        matched = False
-        for k, v in TRANSLATE.items():
-            prefix = k.split("{")[0].strip()
-            if r.startswith(prefix):
-                pretty.append(v)
-                matched = True
-                break
-        if not matched:
+        hit = _TRANSLATE_BY_FIRSTWORD.get(r.split(" ", 1)[0])
+        if hit is not None and r.startswith(hit[0]):
+            pretty.append(hit[1])
+        else:
             pretty.append(r)  # keep unknown reason as-is (e.g., "Blacklisted country: RU", "KYC not verified")
     return pretty
 
 # ---------- DB I/O ----------
-def _fetch_new_trades(conn: sqlite3.Connection, batch: int = 20) -> List[Dict]:
-    cur = conn.execute(
-        """
-        SELECT id, trade_id, timestamp, counterparty, sector, country, symbol, trade_type,
-               quantity, price, notional, currency, kyc_ok, aml_flag
-        FROM trades
-        WHERE status='NEW'
-        ORDER BY id
-        LIMIT ?
-        """,
-        (batch,),
-    )
-    cols = [
-        "id","trade_id","timestamp","counterparty","sector","country","symbol","trade_type",
-        "quantity","price","notional","currency","kyc_ok","aml_flag"
-    ]
-    return [dict(zip(cols, row)) for row in cur.fetchall()]
-
-def _persist_scores_auto(
-    conn: sqlite3.Connection,
-    *,
-    trade_id: str,
-    rule_score: float,
-    ml_score: float,
-    combined: float,
-    decision: str,
-    severity: str,
-    reasons_str: str,
-) -> None:
-    cols = set(_table_columns(conn, "risk_scores"))
+# SQLite unloads (dlcloses) a connection's extensions when it closes unless the extension's
+# init returned SQLITE_OK_LOAD_PERMANENTLY, which would leave the registered VFS pointing at
+# unmapped code. Holding our own ctypes handle on the library (never released) keeps it
+# mapped for the life of the process, whatever order connections close in at exit.
+_vfs_lib: Optional[ctypes.CDLL] = None
+_vfs_lock = threading.Lock()  # main thread and the writer thread both connect
+
+def _load_vfs_extension() -> None:
+    """Load the VFS extension once; VFS registration is process-wide, so any connection will do."""
+    global _vfs_lib
+    if not SQLITE_VFS_EXTENSION:
+        return
+    with _vfs_lock:
+        if _vfs_lib is not None:
+            return
+        boot = sqlite3.connect(":memory:")
+        try:
+            boot.enable_load_extension(True)  # AttributeError if Python's sqlite3 was built without it
+            boot.load_extension(SQLITE_VFS_EXTENSION)
+            # same lookup as sqlite3_load_extension: the path as given, then with the platform suffix
+            suffix = {"win32": ".dll", "darwin": ".dylib"}.get(sys.platform, ".so")
+            for path in (SQLITE_VFS_EXTENSION, SQLITE_VFS_EXTENSION + suffix):
+                try:
+                    _vfs_lib = ctypes.CDLL(path)
+                    break
+                except OSError:
+                    continue
+            else:
+                raise OSError(f"cannot pin VFS extension {SQLITE_VFS_EXTENSION!r} in memory")
+        finally:
+            boot.close()
+
+def _connect(path: str = DB_PATH) -> sqlite3.Connection:
+    _load_vfs_extension()  # no-op unless RISK_SQLITE_VFS_EXTENSION is set
+    if SQLITE_VFS:
+        conn = sqlite3.connect(f"file:{path}?vfs={SQLITE_VFS}", uri=True, isolation_level=None)
+    else:
+        conn = sqlite3.connect(path, isolation_level=None)  # autocommit-like
+    # WAL: the dashboard keeps reading while we write; NORMAL = one WAL sync per batch commit
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")  # 64 MiB
+    conn.execute("PRAGMA wal_autocheckpoint=1000")
+    return conn
+
+# hot-path SQL is built once: every execute passes the same string, so sqlite3's
+# per-connection statement cache hands back the already-prepared statement.
+# Columns come back in risk_engine.Trade field order, so rows map via Trade._make
+FETCH_SQL = f"""
+    SELECT {", ".join(TRADE_FIELDS)}
+    FROM trades
+    WHERE status='NEW' AND id > ?
+    ORDER BY id
+    LIMIT ?
+"""
+# FETCH_SQL returns every NEW row in (after_id, last fetched id], and new trades only ever get
+# higher ids, so one range UPDATE marks exactly the fetched batch (no per-row id list)
+MARK_PROCESSED_SQL = "UPDATE trades SET status='PROCESSED' WHERE id BETWEEN ? AND ? AND status='NEW'"
+
+def _fetch_new_trades(conn: sqlite3.Connection, after_id: int, batch: int = 20) -> List[Trade]:
+    """Read-only: NEW rows past the last id already handed to the writer."""
+    return [Trade._make(row) for row in conn.execute(FETCH_SQL, (after_id, batch)).fetchall()]
 
+# INSERT variant = (sql, slots): slots pick that variant's params out of the full tuple
+#   scores: (trade_id, rule_score, ml_score, combined, decision, severity, reasons_str)
+#   alerts: (trade_id, severity_text, message)
+InsertVariant = Tuple[str, Tuple[int, ...]]
+
+# (schema_version, scores_variant, alert_variant), kept by the DBWriter whose inserts they shape
+SchemaVariants = Tuple[int, InsertVariant, InsertVariant]
+
+# risk_scores.trade_id is UNIQUE (idx_rs_tid): a repeated trade_id keeps its first score
+# instead of failing the whole batch and leaving it NEW forever
+def _pick_scores_insert(cols: set) -> InsertVariant:
     if {"rule_score", "ml_score", "combined_score", "decision", "severity", "reasons"}.issubset(cols):
         # Newer schema
-        conn.execute(
-            """
-            INSERT INTO risk_scores(
+        return ("""
+            INSERT OR IGNORE INTO risk_scores(
                 trade_id, rule_score, ml_score, combined_score, decision, severity, reasons
             ) VALUES (?,?,?,?,?,?,?)
-            """,
-            (trade_id, rule_score, ml_score, combined, decision, severity, reasons_str),
-        )
-    elif {"base_rule_score", "ml_anomaly_score", "combined_score", "decision", "reason"}.issubset(cols):
+            """, (0, 1, 2, 3, 4, 5, 6))
+    if {"base_rule_score", "ml_anomaly_score", "combined_score", "decision", "reason"}.issubset(cols):
         # Older schema
-        conn.execute(
-            """
-            INSERT INTO risk_scores(
+        return ("""
+            INSERT OR IGNORE INTO risk_scores(
                 trade_id, base_rule_score, ml_anomaly_score, combined_score, decision, reason
             ) VALUES (?,?,?,?,?,?)
-            """,
-            (trade_id, rule_score, ml_score, combined, decision, reasons_str),
-        )
-    else:
-        # Minimal fallback (last resort)
-        conn.execute(
-            """
-            INSERT INTO risk_scores(trade_id, combined_score, decision)
-            VALUES (?,?,?)
-            """,
-            (trade_id, combined, decision),
-        )
-
-def _insert_alert_auto(conn: sqlite3.Connection, trade_id: str, severity_text: str, message: str) -> None:
-    cols = set(_table_columns(conn, "alerts"))
+            """, (0, 1, 2, 3, 4, 6))
+    # Minimal fallback (last resort)
+    return ("INSERT OR IGNORE INTO risk_scores(trade_id, combined_score, decision) VALUES (?,?,?)", (0, 3, 4))
 
+def _pick_alert_insert(cols: set) -> InsertVariant:
     if {"trade_id", "level", "message"}.issubset(cols):
-        conn.execute("INSERT INTO alerts(trade_id, level, message) VALUES (?,?,?)",
-                     (trade_id, severity_text, message))
-    elif {"trade_id", "severity", "message"}.issubset(cols):
-        conn.execute("INSERT INTO alerts(trade_id, severity, message) VALUES (?,?,?)",
-                     (trade_id, severity_text, message))
-    elif {"trade_id", "message"}.issubset(cols):
+        return "INSERT INTO alerts(trade_id, level, message) VALUES (?,?,?)", (0, 1, 2)
+    if {"trade_id", "severity", "message"}.issubset(cols):
+        return "INSERT INTO alerts(trade_id, severity, message) VALUES (?,?,?)", (0, 1, 2)
+    if {"trade_id", "message"}.issubset(cols):
         # Last resort: no severity column present
-        conn.execute("INSERT INTO alerts(trade_id, message) VALUES (?,?)",
-                     (trade_id, message))
-    else:
-        # If schema is unexpected, create a lightweight entry in risk_scores as a log instead
-        conn.execute(
-            "INSERT INTO risk_scores(trade_id, combined_score, decision) VALUES (?,?,?)",
-            (trade_id, 0.0, f"ALERT_FALLBACK:{severity_text}")
-        )
+        return "INSERT INTO alerts(trade_id, message) VALUES (?,?)", (0, 2)
+    # If schema is unexpected, create a lightweight entry in risk_scores as a log instead
+    return ("INSERT OR IGNORE INTO risk_scores(trade_id, combined_score, decision) "
+            "VALUES (?, 0.0, 'ALERT_FALLBACK:' || ?)", (0, 1))
+
+def _insert_variants(conn: sqlite3.Connection, cached: Optional[SchemaVariants]) -> SchemaVariants:
+    """One PRAGMA per batch; table_info only re-runs when the schema actually changed."""
+    version = conn.execute("PRAGMA schema_version").fetchone()[0]
+    if cached is None or cached[0] != version:
+        cached = (version,
+                  _pick_scores_insert(set(_table_columns(conn, "risk_scores"))),
+                  _pick_alert_insert(set(_table_columns(conn, "alerts"))))
+    return cached
+
+def _bind(insert: InsertVariant, full: tuple) -> tuple:
+    return tuple(full[i] for i in insert[1])
+
+class DBWriter:
+    """Single writer: a daemon thread owning the only write connection.
+
+    Jobs are (sql, params_iterable) pairs run with executemany; each batch ends with a
+    COMMIT job, so a batch is one transaction and a crash before it commits leaves its
+    trades NEW. Scoring the next batch overlaps the previous batch's commit.
+    """
+
+    COMMIT = object()
+    CLOSE = object()
+
+    def __init__(self, path: str = DB_PATH):
+        self.last_id = 0  # highest trade id handed to the writer so far
+        self.variants: Optional[SchemaVariants] = None  # INSERT variants for this writer's DB
+        self.error: Optional[BaseException] = None
+        self._path = path
+        # bounded, so the reader blocks instead of running ahead of a slow or stalled writer
+        self._jobs: "queue.Queue[Tuple[object, object]]" = queue.Queue(maxsize=WRITER_QUEUE_JOBS)
+        self._thread = threading.Thread(target=self._loop, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def alive(self) -> bool:
+        return self.error is None and self._thread.is_alive()
+
+    def check(self) -> None:
+        """Raise if the writer thread has stopped (its error, if any, is the cause)."""
+        if not self.alive():
+            raise RuntimeError("DB writer stopped") from self.error
+
+    def submit(self, jobs: List[Tuple[str, List[tuple]]], on_commit=None) -> None:
+        for job in jobs:
+            self._put(job)
+        self._put((self.COMMIT, on_commit))
+
+    def close(self) -> None:
+        """Flush everything queued so far, then stop the thread."""
+        if self._thread.is_alive():
+            self._put((self.CLOSE, None), check=False)
+        self._thread.join()
+
+    def _put(self, job: Tuple[object, object], check: bool = True) -> None:
+        # wait for room, but give up as soon as the thread that would make it has died
+        while True:
+            if check:
+                self.check()
+            elif not self._thread.is_alive():
+                return
+            try:
+                self._jobs.put(job, timeout=IDLE_POLL_S)
+                return
+            except queue.Full:
+                pass
+
+    def _loop(self) -> None:
+        conn = None
+        try:
+            conn = _connect(self._path)
+            while True:
+                sql, arg = self._jobs.get()
+                if sql is self.CLOSE:
+                    break
+                if sql is self.COMMIT:
+                    conn.commit()
+                    if arg is not None:
+                        arg()
+                    continue
+                if not conn.in_transaction:
+                    conn.execute("BEGIN IMMEDIATE")
+                conn.executemany(sql, arg)
+        except Exception as e:
+            # drop the half-written batch; main() raises on its next check()/submit()
+            self.error = e
+            if conn is not None and conn.in_transaction:
+                conn.rollback()
+        finally:
+            if conn is not None:
+                conn.close()
 
 # ---------- main processing ----------
-def process_once(conn: sqlite3.Connection, model) -> int:
-    rows = _fetch_new_trades(conn)
-    if not rows:
-        return 0
+def _score_rows(rows: List[Trade], model, engine: RiskEngine,
+                scores_insert: InsertVariant, alert_insert: InsertVariant
+                ) -> Tuple[List[tuple], List[tuple], List[str]]:
+    # ML scores for the whole batch in one model call
+    ml_scores = ml_anomaly_score_batch(rows, model).tolist()  # Python floats once, no float() per trade
+
+    # rule scores + reason bitmasks for the whole batch in one pass
+    rule_scores, reason_bits = engine.score_rows(rows)
 
-    for tr in rows:
-        # 1) Scores
-        rule_s, raw_reasons = rule_based_score(tr, conn)
-        ml_s = ml_anomaly_score(tr, model)
-        combined = float(rule_s) + float(ml_s)
+    scores_rows: List[tuple] = []
+    alert_rows: List[tuple] = []
+    messages: List[str] = []
+    reasons_of, translate = engine.reasons, _translate_reasons  # hoisted attribute/global lookups
+    # ALLOW trades raise no alert, so unless DEBUG is on their reasons/message are never formatted
+    # (risk_scores keeps NULL as their reason: "not recorded", as opposed to "no rule fired")
+    explain_allow = log.isEnabledFor(logging.DEBUG)
+    for tr, rule_s, bits, ml_s in zip(rows, rule_scores.tolist(), reason_bits.tolist(), ml_scores):
+        trade_id = tr.trade_id
 
-        # 2) Decision
+        # 1) Scores -> decision
+        combined = rule_s + ml_s
         decision, severity = _decide(combined)
 
-        # 3) Translate reasons
-        reasons = _translate_reasons(raw_reasons)
+        if decision == "ALLOW" and not explain_allow:
+            scores_rows.append(_bind(scores_insert, (trade_id, rule_s, ml_s, combined,
+                                                     decision, severity, None)))
+            continue
+
+        # 2) Translate reasons
+        reasons = translate(reasons_of(bits, tr))
         reasons_str = "; ".join(reasons) if reasons else "No rule violations"
 
-        # 4) Persist scores (schema-aware)
-        _persist_scores_auto(
-            conn,
-            trade_id=tr["trade_id"],
-            rule_score=float(rule_s),
-            ml_score=float(ml_s),
-            combined=combined,
-            decision=decision,
-            severity=severity,
-            reasons_str=reasons_str,
-        )
-
-        # 5) Mark processed
-        conn.execute("UPDATE trades SET status='PROCESSED' WHERE id=?", (tr["id"],))
-
-        # 6) Insert alert (schema-aware)
-        msg = f"{decision} trade {tr['trade_id']} score={combined:.2f} reasons: {reasons_str}"
-        _insert_alert_auto(conn, tr["trade_id"], severity_text=severity, message=msg)
-        print(msg)
-
-    conn.commit()
+        # 3) Scores row + alert row (schema-aware)
+        scores_rows.append(_bind(scores_insert, (trade_id, rule_s, ml_s, combined,
+                                                 decision, severity, reasons_str)))
+        msg = f"{decision} trade {trade_id} score={combined:.2f} reasons: {reasons_str}"
+        alert_rows.append(_bind(alert_insert, (trade_id, severity, msg)))
+        messages.append(msg)
+    return scores_rows, alert_rows, messages
+
+def process_once(conn: sqlite3.Connection, model, engine: RiskEngine, writer: DBWriter) -> int:
+    # conn only reads here; the status flip and inserts commit together on the writer thread,
+    # so a crash before that COMMIT leaves the whole batch NEW
+    rows = _fetch_new_trades(conn, writer.last_id)
+    if not rows:
+        return 0
+    # conn reads the same DB the writer writes, so its schema picks the writer's INSERTs
+    writer.variants = _insert_variants(conn, writer.variants)
+    _, scores_insert, alert_insert = writer.variants
+    scores_rows, alert_rows, messages = _score_rows(rows, model, engine, scores_insert, alert_insert)
+    writer.submit([
+        (MARK_PROCESSED_SQL, [(writer.last_id + 1, rows[-1].id)]),
+        (scores_insert[0], scores_rows),
+        (alert_insert[0], alert_rows),
+    ], on_commit=lambda: _log_decisions(messages))
+    writer.last_id = rows[-1].id
     return len(rows)
 
+def _data_version(conn: sqlite3.Connection) -> int:
+    # bumps whenever *another* connection commits to the DB (our own commits don't move it)
+    return conn.execute("PRAGMA data_version").fetchone()[0]
+
+def _wait_for_commit(conn: sqlite3.Connection, seen: int, timeout: float = IDLE_TIMEOUT_S,
+                     writer: Optional[DBWriter] = None) -> None:
+    """Idle until some other connection commits after `seen` was read, the timeout passes,
+    or `writer` stops."""
+    deadline = time.monotonic() + timeout
+    while _data_version(conn) == seen and time.monotonic() < deadline:
+        if writer is not None and not writer.alive():
+            return
+        time.sleep(IDLE_POLL_S)
+
 def main() -> None:
+    listener = _start_logging()
     model = load_model()
-    conn = sqlite3.connect(DB_PATH, isolation_level=None)  # autocommit-like
-    print("Risk processor started. Polling every 2s. Ctrl+C to stop.")
+    conn = _connect()  # reads only; all writes go through the writer thread
+    writer = DBWriter()
+    engine = rule_context(conn)  # rules + sanctions in memory; reloaded only on a user_version bump
+    log.info(f"Risk processor started. Waking on new commits (checked every {IDLE_POLL_S:g}s). Ctrl+C to stop.")
     try:
         while True:
-            n = process_once(conn, model)
+            # read the version *before* fetching: a commit landing after an empty fetch still wakes us
+            writer.check()  # a failed batch stops the processor instead of idling next to a dead writer
+            seen = _data_version(conn)
+            engine = rule_context(conn, engine)
+            n = process_once(conn, model, engine, writer)
             if n == 0:
-                time.sleep(2.0)
+                _wait_for_commit(conn, seen, writer=writer)
     except KeyboardInterrupt:
-        print("Stopping processor.")
+        log.info("Stopping processor.")
     finally:
+        writer.close()
         conn.close()
+        listener.stop()  # flushes whatever is still queued
 
 if __name__ == "__main__":
     main()
@@ -1,8 +1,10 @@
-import pandas as pd, numpy as np, pickle
+import pandas as pd, numpy as np, joblib
 from sklearn.ensemble import IsolationForest
 
+from risk_engine import FLAT_MODEL_PATH, FlatForest
+
 SEED_DATA = "data/seed_trades.csv"
-MODEL_PATH = "model_isoforest.pkl"
+MODEL_PATH = "model_isoforest.joblib"
 
 # Features to train on (drop identifiers/text fields)
 FEATURES = ["quantity","price","notional"]
@@ -13,13 +15,22 @@ def main():
     benign = df[(df["kyc_ok"]==1) & (df["aml_flag"]==0)]
     X = benign[FEATURES].copy()
 
-    model = IsolationForest(n_estimators=200, contamination=0.02, random_state=42)
+    # max_samples=256 is the standard isolation-forest subsample: sklearn then caps every tree at
+    # depth ceil(log2(256)) = 8, so 100 small trees stay cache-resident at scoring time. Scores
+    # are 2^(-E[h(x)] / c(256)) with c(n) = 2*H(n-1) - 2*(n-1)/n, i.e. c(256) ~= 10.24 is the
+    # average path length the depths are normalised against.
+    # trees are independent, so fit them across all cores (per-tree seeds come from random_state,
+    # so the forest is the same as a single-core fit)
+    model = IsolationForest(n_estimators=100, max_samples=256, max_features=1.0,
+                            contamination=0.02, random_state=42, n_jobs=-1)
     model.fit(X)
+    model.set_params(n_jobs=1)  # scoring batches are small: no joblib dispatch at inference
 
-    with open(MODEL_PATH, "wb") as f:
-        pickle.dump(model, f)
+    joblib.dump(model, MODEL_PATH, compress=0)  # uncompressed: loadable with mmap_mode="r"
+    # flat node arrays for the processor's scorer (memory-mapped, no sklearn trees rebuilt)
+    FlatForest.from_model(model).save(FLAT_MODEL_PATH)
 
-    print(f"Model trained on {len(X)} rows and saved to {MODEL_PATH}")
+    print(f"Model trained on {len(X)} rows and saved to {MODEL_PATH} (+ {FLAT_MODEL_PATH})")
 
 if __name__ == "__main__":
     main()